@@ -2,52 +2,108 @@
 #
 # SPDX-License-Identifier: MIT
 #
+import concurrent.futures
+import fnmatch
+import functools
 import json
 import logging
 import os
+import queue
 import re
-import shutil
 import subprocess
 import time
-from contextlib import contextmanager
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from textwrap import dedent
 from typing import NamedTuple, Optional
-from threading import Thread
+from threading import Condition, Event, Lock, RLock, Thread, current_thread
+from types import SimpleNamespace
 
 import psutil
 import serial
 import serial.tools.list_ports
 
-logging.basicConfig(format="%(asctime)s %(threadName)s %(levelname)s %(message)s",
-                    level=logging.INFO)
+try:
+    import objc
+    from Foundation import NSBundle
+except ImportError:
+    objc = None
+
+# Device threads only merge the message and enqueue the record, so they never contend on the stream
+# lock; the timestamped line is formatted and written on the listener thread, which main() runs
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(levelname)s %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+
+_log = logging.getLogger("multiflash")
+if os.environ.get("MULTIFLASH_DEBUG"):
+    _log.setLevel(logging.DEBUG)
 
 DESIRED_CPY_VERSION = "8.0.5"
 SOURCE_CONTENT = Path(__file__).parent / "content"
-EMPTY_FS_FILES = {
-    ".fseventsd",
-    ".fseventsd/no_log",
-    ".metadata_never_index",
-    ".Trashes",
+FIRMWARE = Path(__file__).parent / "firmware.uf2"
+EMPTY_FS_FILES = frozenset({
     "code.py",
     "lib",
     "boot_out.txt",
-}
-EMPTY_FS_IGNORE = {"fseventsd/no_log"}
+})
 
+VERSION_PREFIX = b"Adafruit CircuitPython "
 COPY_IGNORE = [".DS_Store", "__pycache__", "*.pyc", "._*", ".*"]
+COPY_IGNORE_RE = re.compile("|".join(fnmatch.translate(pattern) for pattern in COPY_IGNORE))
+# Skipped (along with AppleDouble "._*" files) before descending, so macOS metadata dirs are never read
+SCAN_IGNORE = frozenset({".DS_Store", "__pycache__", ".fseventsd", ".Trashes", ".metadata_never_index"})
+
+# USB enumeration via system_profiler is slow, so only rerun it on hotplug or after RESCAN_INTERVAL
+RESCAN_INTERVAL = 5
+HOTPLUG_POLL_INTERVAL = 0.25
+PARTITIONS_TTL = 1
+NEGATIVE_TTL = 2
+HOTPLUG_DEV_PREFIXES = ("disk", "cu.usbmodem")
+
+REPL_TIMEOUT = 2
+REPL_POLL_INTERVAL = 0.05
+REPL_ATTEMPTS = 10
+# Flashing is I/O-bound (reboots, device and REPL waits), so this is a fixed cap, not a CPU count
+MAX_WORKERS = 24
+SYNC_AHEAD = 2
+
+kIOMasterPortDefault = 0
+kIORegistryIterateRecursively = 1
+
+hotplug_event = Event()
+# Set by main() on exit so workers abandon their device waits instead of running them to timeout
+stop_event = Event()
+scan_lock = Lock()
+scan_done = Condition(scan_lock)
+scan_generation = 0
+last_scan = 0.0
 
-seen_devices = dict()
-in_progress = set()
-most_recent_devices = []
-done_devices = set()
 
 DONE_SCRIPT = """
     from adafruit_circuitplayground import cp
     cp.pixels.brightness = 0.0625
     cp.pixels[:] = [0x22cc28 for n in range(10)]
 """
+ERASE_SCRIPT = """
+    import storage
+    storage.erase_filesystem()
+"""
+
+
+class ShutdownRequested(Exception):
+    pass
+
+
+def check_stop():
+    if stop_event.is_set():
+        raise ShutdownRequested("Shutting down")
 
 
 class DeviceInfo(NamedTuple):
@@ -67,7 +123,171 @@ class DeviceInfo(NamedTuple):
         return f"DeviceInfo({self.serial_no} {self.tty_device}, {self.mount_point})"
 
 
-def find_devices():
+@dataclass
+class DiscoveryState:
+    """Device bookkeeping shared by the main loop and the flashing workers."""
+
+    lock: RLock = field(default_factory=RLock)
+    seen_devices: dict = field(default_factory=dict)
+    in_progress: set = field(default_factory=set)
+    done_devices: set = field(default_factory=set)
+    most_recent_devices: tuple = ()
+    most_recent_serials: frozenset = frozenset()
+    # serial_num -> monotonic time until which a failed lookup isn't retried
+    negative: dict = field(default_factory=dict)
+    partitions: list = field(default_factory=list)
+    partitions_fetched_at: float = 0.0
+
+    def update_scan(self, items):
+        with self.lock:
+            self.most_recent_devices = tuple(items)
+            self.most_recent_serials = frozenset(item.get("serial_num") for item in self.most_recent_devices)
+
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return self.most_recent_devices
+
+    def snapshot_serials(self) -> frozenset:
+        with self.lock:
+            return self.most_recent_serials
+
+    def mark_seen(self, device: DeviceInfo) -> bool:
+        """Record device, returning False if the same sighting was already recorded recently."""
+        with self.lock:
+            if (
+                device.serial_no in self.seen_devices
+                and self.seen_devices[device.serial_no] == device
+                and (datetime.now() - device.last_seen_at) <= timedelta(seconds=120)
+            ):
+                return False
+            self.seen_devices[device.serial_no] = device
+            return True
+
+    def is_negative(self, serial_no: str) -> bool:
+        with self.lock:
+            return self.negative.get(serial_no, 0) > time.monotonic()
+
+    def mark_negative(self, serial_no: str):
+        with self.lock:
+            self.negative[serial_no] = time.monotonic() + NEGATIVE_TTL
+
+    def invalidate(self):
+        """Forget negative results and cached partitions after a hotplug."""
+        with self.lock:
+            self.negative.clear()
+            self.partitions_fetched_at = 0.0
+
+    def disk_partitions(self) -> list:
+        with self.lock:
+            if time.monotonic() - self.partitions_fetched_at > PARTITIONS_TTL:
+                self.partitions = psutil.disk_partitions()
+                self.partitions_fetched_at = time.monotonic()
+            return self.partitions
+
+    def is_in_progress(self, serial_no: str) -> bool:
+        with self.lock:
+            return serial_no in self.in_progress
+
+    def is_done(self, serial_no: str) -> bool:
+        with self.lock:
+            return serial_no in self.done_devices
+
+    def mark_in_progress(self, serial_no: str) -> bool:
+        """Claim serial_no for flashing, returning False if it is already being flashed."""
+        with self.lock:
+            if serial_no in self.in_progress:
+                return False
+            self.in_progress.add(serial_no)
+            return True
+
+    def mark_done(self, serial_no: str):
+        with self.lock:
+            self.done_devices.add(serial_no)
+
+    def finish(self, serial_no: str, done: bool) -> bool:
+        """Release serial_no after its task ends, returning False if it wasn't in progress."""
+        with self.lock:
+            if serial_no not in self.in_progress:
+                return False
+            self.in_progress.remove(serial_no)
+            if done:
+                self.done_devices.add(serial_no)
+            return True
+
+
+state = DiscoveryState()
+
+
+def load_iokit() -> Optional[SimpleNamespace]:
+    """Bind the few IOKit calls needed for USB enumeration, or None without pyobjc."""
+    if objc is None:
+        return None
+    functions = {}
+    try:
+        objc.loadBundleFunctions(NSBundle.bundleWithIdentifier_("com.apple.framework.IOKit"), functions, [
+            ("IOServiceMatching", b"@*"),
+            ("IOServiceGetMatchingServices", b"iI@o^I"),
+            ("IOIteratorNext", b"II"),
+            ("IOObjectRelease", b"iI"),
+            ("IORegistryEntryCreateCFProperty", b"@I@@I"),
+            ("IORegistryEntrySearchCFProperty", b"@I*@@I"),
+        ])
+    except (AttributeError, objc.error) as exc:
+        _log.warning("IOKit unavailable, using system_profiler: %s", exc)
+        return None
+    return SimpleNamespace(**functions)
+
+
+IOKIT = load_iokit()
+
+
+def find_devices_iokit() -> list:
+    """Enumerate USB devices straight from the IORegistry, in the same shape as system_profiler's items."""
+    result, iterator = IOKIT.IOServiceGetMatchingServices(
+        kIOMasterPortDefault, IOKIT.IOServiceMatching(b"IOUSBHostDevice"), None
+    )
+    if result != 0:
+        raise OSError(f"IOServiceGetMatchingServices failed: {result:#x}")
+
+    items = []
+    try:
+        while entry := IOKIT.IOIteratorNext(iterator):
+            try:
+                vendor_id = IOKIT.IORegistryEntryCreateCFProperty(entry, "idVendor", None, 0)
+                serial_num = IOKIT.IORegistryEntryCreateCFProperty(entry, "USB Serial Number", None, 0)
+                item = {
+                    "vendor_id": f"0x{vendor_id or 0:04x}",
+                    "serial_num": str(serial_num) if serial_num else None,
+                }
+                # The whole-disk IOMedia sits somewhere below the USB device
+                bsd_name = IOKIT.IORegistryEntrySearchCFProperty(
+                    entry, b"IOService", "BSD Name", None, kIORegistryIterateRecursively
+                )
+                if bsd_name:
+                    # Resolve the volume here, so the item carries it the same way system_profiler's do
+                    media = {"bsd_name": str(bsd_name)}
+                    mount_point = resolve_mount_point(media)
+                    if mount_point:
+                        media["volumes"] = [{"mount_point": mount_point}]
+                    item["Media"] = [media]
+                items.append(item)
+            finally:
+                IOKIT.IOObjectRelease(entry)
+    finally:
+        IOKIT.IOObjectRelease(iterator)
+    return items
+
+
+def find_devices() -> list:
+    if IOKIT:
+        try:
+            return find_devices_iokit()
+        except OSError as exc:
+            _log.warning("IOKit enumeration failed, using system_profiler: %s", exc)
+    return list(find_devices_profiler())
+
+
+def find_devices_profiler():
     usb_data = json.loads(
         subprocess.run(
             "/usr/sbin/system_profiler -json SPUSBDataType SPStorageDataType".split(), capture_output=True
@@ -86,6 +306,37 @@ def find_devices():
     yield from recurse(usb_data)
 
 
+def watch_hotplug():
+    """Set hotplug_event whenever a USB disk/serial node or a mount appears or disappears."""
+    previous = None
+    while True:
+        try:
+            nodes = {name for name in os.listdir("/dev") if name.startswith(HOTPLUG_DEV_PREFIXES)}
+            nodes.update(part.mountpoint for part in psutil.disk_partitions())
+        except OSError as exc:
+            _log.error("Hotplug watch failed: %s", exc)
+            nodes = None
+        if nodes != previous:
+            previous = nodes
+            hotplug_event.set()
+        time.sleep(HOTPLUG_POLL_INTERVAL)
+
+
+def resolve_mount_point(media: dict) -> Optional[str]:
+    mount_point = None
+    volumes = media.get("volumes", [])
+    if volumes and "mount_point" in volumes[0]:
+        mount_point = volumes[0]["mount_point"]
+
+    if not mount_point:
+        device_path = "/dev/" + media["bsd_name"]
+        for part in state.disk_partitions():
+            if part.device == device_path:
+                mount_point = part.mountpoint
+                break
+    return mount_point
+
+
 def find_mount_point(item: dict) -> Optional[DeviceInfo]:
     mount_point = None
     try:
@@ -93,77 +344,91 @@ def find_mount_point(item: dict) -> Optional[DeviceInfo]:
         if not media:
             return
 
-        volumes = media[0].get("volumes", [])
-        if volumes and "mount_point" in volumes[0]:
-            mount_point = media[0]["volumes"][0]["mount_point"]
-
-        if not mount_point:
-            parts = psutil.disk_partitions()
-            for part in parts:
-                device_path = "/dev/" + media[0]["bsd_name"]
-                if part.device == device_path:
-                    mount_point = part.mountpoint
-                    break
-
+        mount_point = resolve_mount_point(media[0])
         if not mount_point:
-            logging.debug("No disk device found for %s", item)
+            _log.debug("No disk device found for %s", item)
             return
 
         serial_no = item["serial_num"]
         return DeviceInfo(serial_no=serial_no, tty_device=None, mount_point=mount_point, last_seen_at=datetime.now())
     except (TypeError, KeyError, UnboundLocalError) as exc:
-        logging.exception("Error handling discovered device", exc_info=exc)
+        _log.exception("Error handling discovered device", exc_info=exc)
+
+
+def find_serial_ports() -> dict:
+    """Enumerate serial ports once per discovery tick, keyed by USB serial number."""
+    return {port.serial_number: port for port in serial.tools.list_ports.comports() if port.serial_number}
 
 
-def find_serial_port(usb_device: Optional[DeviceInfo]) -> Optional[DeviceInfo]:
+def find_serial_port(usb_device: Optional[DeviceInfo], ports_by_serial: dict) -> Optional[DeviceInfo]:
     if not usb_device:
         return None
 
-    for serial_port in serial.tools.list_ports.comports():
-        if not serial_port.serial_number:
-            continue
-
-        if serial_port.serial_number != usb_device.serial_no:
-            continue
+    serial_port = ports_by_serial.get(usb_device.serial_no)
+    if not serial_port:
+        return None
 
-        tty_path = serial_port.device.replace("cu", "tty")
-        with_tty = DeviceInfo(
-            tty_device=tty_path,
-            serial_no=usb_device.serial_no,
-            mount_point=usb_device.mount_point,
-            last_seen_at=usb_device.last_seen_at,
-        )
-        return with_tty
+    tty_path = serial_port.device.replace("cu", "tty")
+    with_tty = DeviceInfo(
+        tty_device=tty_path,
+        serial_no=usb_device.serial_no,
+        mount_point=usb_device.mount_point,
+        last_seen_at=usb_device.last_seen_at,
+    )
+    return with_tty
+
+
+def scan_devices(fetch=True) -> tuple:
+    """Return a snapshot of the latest USB scan, rescanning first if it is stale.
+
+    Shared by the main loop and every flashing worker, so concurrent callers wait for
+    one system_profiler run instead of each starting their own.
+    """
+    global last_scan, scan_generation
+    with scan_done:
+        if fetch and (hotplug_event.is_set() or time.monotonic() - last_scan > RESCAN_INTERVAL):
+            if hotplug_event.is_set():
+                state.invalidate()
+            hotplug_event.clear()
+            state.update_scan(find_devices())
+            last_scan = time.monotonic()
+            scan_generation += 1
+            scan_done.notify_all()
+        return state.snapshot()
+
+
+def wait_for_scan(generation: int, timeout: float):
+    """Block until a USB scan newer than generation has finished, or timeout elapses."""
+    with scan_done:
+        scan_done.wait_for(lambda: scan_generation != generation, timeout)
 
 
 def discover_devices(once=False, specific_serial_no=None, fetch=True):
     while True:
-        if fetch:
-            most_recent_devices.clear()
-            most_recent_devices.extend(find_devices())
-        for item in most_recent_devices:
+        usb_items = scan_devices(fetch)
+        ports_by_serial = find_serial_ports()
+        for item in usb_items:
             if item.get("vendor_id") != "0x239a":
                 continue
-            device = find_serial_port(find_mount_point(item))
+            serial_num = item.get("serial_num")
+            if state.is_negative(serial_num) and not hotplug_event.is_set():
+                continue
+            device = find_serial_port(find_mount_point(item), ports_by_serial)
             if not device:
+                _log.debug("No mount or serial port yet for %s", serial_num)
+                state.mark_negative(serial_num)
                 continue
             if specific_serial_no and device.serial_no == specific_serial_no:
                 yield device
                 continue
-            if (
-                device.serial_no in seen_devices
-                and seen_devices[device.serial_no] == device
-                and (datetime.now() - device.last_seen_at) <= timedelta(seconds=120)
-            ):
-                logging.warning("Ignoring %s", device.serial_no)
+            if not state.mark_seen(device):
+                _log.warning("Ignoring %s", device.serial_no)
                 continue
 
-            seen_devices[device.serial_no] = device
-
-            if device.serial_no in done_devices and device.serial_no not in str(most_recent_devices):
+            if state.is_done(device.serial_no) and device.serial_no not in state.snapshot_serials():
                 run_script(device, script=DONE_SCRIPT, description="rerun done script")
 
-            if device and device.serial_no not in in_progress and device not in done_devices:
+            if not state.is_in_progress(device.serial_no):
                 yield device
 
         time.sleep(0.1)
@@ -171,22 +436,27 @@ def discover_devices(once=False, specific_serial_no=None, fetch=True):
             return
 
 
+@functools.lru_cache(maxsize=None)
+def firmware_image() -> bytes:
+    # Read once and shared by every device thread
+    return FIRMWARE.read_bytes()
+
+
 def bootloader_flash(device: DeviceInfo):
     # Install CircuitPython
-    logging.info("Installing firmware.uf2 to %s (%s)", device.mount_point, device.serial_no)
-    (Path(device.mount_point) / "firmware.uf2").write_bytes(
-        Path("firmware.uf2").read_bytes())
+    _log.info("Installing firmware.uf2 to %s (%s)", device.mount_point, device.serial_no)
+    (Path(device.mount_point) / "firmware.uf2").write_bytes(firmware_image())
     wait_for_device(device)
-    logging.info("Done bootloader for %s", device.mount_point)
+    _log.info("Done bootloader for %s", device.mount_point)
 
 
 def wait_for_device(device, timeout=60, require_mount=False, reason=""):
-    started = datetime.now()
-    logging.info("Waiting for %s %s", device.serial_no, f" ({reason})" if reason else "")
+    deadline = time.monotonic() + timeout
+    _log.info("Waiting for %s %s", device.serial_no, f" ({reason})" if reason else "")
     orig_device = device
     while True:
-        if datetime.now() - started > timedelta(seconds=timeout):
-            raise TimeoutError("Device not seen after %d", timeout)
+        check_stop()
+        generation = scan_generation
         devices = list(discover_devices(once=True, specific_serial_no=orig_device.serial_no))
         ok = False
         device = None
@@ -200,29 +470,59 @@ def wait_for_device(device, timeout=60, require_mount=False, reason=""):
         if ok:
             return device
 
-        time.sleep(0.2)
+        # Wake early if another thread rescans; otherwise come back round and let our own
+        # discover_devices() pass run the scan once hotplug (or RESCAN_INTERVAL) asks for one
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Device not seen after {timeout}s")
+        wait_for_scan(generation, min(remaining, HOTPLUG_POLL_INTERVAL))
 
 
 def get_circuitpython_version(device):
-    boot_contents = (Path(device.mount_point) / "boot_out.txt").read_text(encoding="utf-8")
     # Adafruit CircuitPython 7.2.5 on 2022-04-06; Adafruit Circuit Playground Bluefruit with nRF52840
     # Board ID:circuitplayground_bluefruit
-    version = re.search(r"^Adafruit CircuitPython (\S+) on.*", boot_contents)
+    with (Path(device.mount_point) / "boot_out.txt").open("rb") as boot_out:
+        first_line = boot_out.readline()
+    _, found, rest = first_line.partition(VERSION_PREFIX)
+    if not found:
+        raise ValueError(f"Unrecognised boot_out.txt: {first_line!r}")
     # board_id = re.match(r'^Board ID:(\S+)')
-    return version.group(1)
+    return rest.split(b" ", 1)[0].decode("ascii")
+
+
+def _scan(path, ignore: Optional[re.Pattern] = None, descend: Optional[frozenset] = None):
+    """Recursively yield os.DirEntry objects below path, skipping junk files.
+
+    DirEntry caches the file type from the directory read, so is_dir()/is_file() don't
+    cost another round-trip to the (slow) USB mass-storage device. Ignored names are
+    checked before recursing so their whole subtree is skipped. If descend is given, only
+    directories with those names are recursed into.
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            name = entry.name
+            if name in SCAN_IGNORE or name.startswith("._"):
+                continue
+            if ignore and ignore.match(name):
+                continue
+            yield entry
+            if (descend is None or name in descend) and entry.is_dir(follow_symlinks=False):
+                yield from _scan(entry.path, ignore, descend)
 
 
 def content_flash(device: DeviceInfo):
     # Start by erasing filesystem
     try:
         # Check filesystem is clean
-        mount_point = Path(device.mount_point)
-        fs_contents = set(str(path.relative_to(mount_point)) for path in sorted(mount_point.rglob("*")))
-        extras = fs_contents - EMPTY_FS_FILES - EMPTY_FS_IGNORE
-        missing = EMPTY_FS_FILES - fs_contents - EMPTY_FS_FILES
-
-        if extras or missing:
-            logging.info("Filesystem differences: extra=%s, missing%s", extras, missing)
+        mount_point = device.mount_point
+        # scandir paths are the scanned path joined with the name, so slice off that prefix. Any
+        # directory an empty filesystem doesn't have is already an extra, so there's no need to look inside.
+        prefix_len = len(os.path.join(mount_point, ""))
+        fs_contents = {entry.path[prefix_len:] for entry in _scan(mount_point, descend=EMPTY_FS_FILES)}
+        if fs_contents != EMPTY_FS_FILES:
+            extras = fs_contents - EMPTY_FS_FILES
+            missing = EMPTY_FS_FILES - fs_contents
+            _log.info("Filesystem differences: extra=%s, missing=%s", extras, missing)
             device = erase_filesystem(device)
 
         wait_for_device(device)
@@ -230,27 +530,26 @@ def content_flash(device: DeviceInfo):
         # Check boot version
         cpy_version = get_circuitpython_version(device)
         if cpy_version < DESIRED_CPY_VERSION:
-            logging.warning("Circuit Python version is %s", cpy_version)
-            logging.info("Upgrading")
+            _log.warning("Circuit Python version is %s", cpy_version)
+            _log.info("Upgrading")
 
             with serial.Serial(device.tty_device, timeout=5, exclusive=True) as serial_port:
                 serial_port: serial.Serial
                 acquire_repl(serial_port)
-                logging.info("Entering bootloader to upgrade to %s", DESIRED_CPY_VERSION)
+                _log.info("Entering bootloader to upgrade to %s", DESIRED_CPY_VERSION)
                 serial_port.write(
                     b"import microcontroller\r" b"microcontroller.on_next_reset(microcontroller.RunMode.BOOTLOADER)\r"
                 )
 
-            logging.info("Waiting for device to restart")
+            _log.info("Waiting for device to restart")
             device = wait_for_device(device)
         else:
-            logging.info("Running %s", cpy_version)
+            _log.info("Running %s", cpy_version)
 
-        logging.info("Copying content to board")
+        _log.info("Copying content to board")
         copy_content(device)
-        os.sync()
-        logging.info("Done copying to %s", device)
-        done_devices.add(device.serial_no)
+        _log.info("Done copying to %s", device)
+        state.mark_done(device.serial_no)
 
         run_script(
             device,
@@ -258,39 +557,86 @@ def content_flash(device: DeviceInfo):
             description="Set LEDs",
         )
 
-    except (serial.SerialException, OSError) as exc:
-        logging.error("Exception: %s", str(exc), exc_info=exc)
+    except (serial.SerialException, OSError, ValueError) as exc:
+        _log.error("Exception: %s", str(exc), exc_info=exc)
+
+
+@functools.lru_cache(maxsize=None)
+def content_plan() -> tuple[tuple[str, Optional[bytes]], ...]:
+    """Walk and read SOURCE_CONTENT once, as (relative path, data) pairs; directories have no data.
+
+    Directories come before their contents, so the plan can be replayed in order.
+    """
+    prefix_len = len(os.path.join(SOURCE_CONTENT, ""))
+    plan = []
+    for entry in _scan(SOURCE_CONTENT, ignore=COPY_IGNORE_RE):
+        if entry.is_dir():
+            plan.append((entry.path[prefix_len:], None))
+        else:
+            with open(entry.path, "rb") as src:
+                plan.append((entry.path[prefix_len:], src.read()))
+    return tuple(plan)
+
+
+def sync_and_close(out):
+    try:
+        os.fsync(out.fileno())
+    finally:
+        out.close()
 
 
 def copy_content(device):
-    for src in Path(SOURCE_CONTENT).rglob("*"):
-        if src.stem == '.DS_Store':
-            continue
-        dst = device.mount_point / src.relative_to(SOURCE_CONTENT)
-        if src.is_dir():
-            logging.debug("- mkdir %s", dst)
-            dst.mkdir(0o755, exist_ok=True)
-            continue
-
-        logging.debug("- %s", dst)
-        shutil.copy(src=src, dst=dst)
-        shutil.copymode(src=src, dst=dst)
-    for dotfiles in dst.glob("._*"):
+    debug = _log.isEnabledFor(logging.DEBUG)
+    # fsync waits on the USB device, so let a helper thread flush each file while the next one is
+    # written, with at most SYNC_AHEAD files in flight
+    pending = deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as syncer:
+        for relative_path, data in content_plan():
+            dst = Path(device.mount_point) / relative_path
+            if data is None:
+                if debug:
+                    _log.debug("- mkdir %s", dst)
+                dst.mkdir(0o755, exist_ok=True)
+                continue
+
+            if debug:
+                _log.debug("- %s", dst)
+            if len(pending) >= SYNC_AHEAD:
+                pending.popleft().result()
+            out = open(dst, "wb")
+            try:
+                out.write(data)
+                out.flush()
+            except OSError:
+                out.close()
+                raise
+            pending.append(syncer.submit(sync_and_close, out))
+        while pending:
+            pending.popleft().result()
+    for dotfiles in Path(device.mount_point).glob("._*"):
         dotfiles.unlink()
 
 
+@functools.lru_cache(maxsize=None)
+def prep_script(script: str) -> tuple[bytes, tuple[str, ...]]:
+    """Return the paste-mode payload (terminated with CR and Ctrl-D) and its lines for logging."""
+    script = dedent(script).replace("\n", "\r")
+    return script.encode("utf-8") + b"\r\x04", tuple(script.splitlines())
+
+
 def run_script(device, script, serial_port: Optional[serial.Serial] = None, timeout=15, description: str = ""):
-    logging.info("Obtaining REPL")
-    script = dedent(script).replace("\n", "\r").encode("utf-8")
+    _log.info("Obtaining REPL")
+    payload, script_lines = prep_script(script)
 
     def get_port(retry=True, retries=10, interval=1):
         for attempt in range(retries if retry else 1):
+            check_stop()
             try:
                 if serial_port:
                     return serial_port
                 return serial.Serial(device.tty_device, timeout=timeout, exclusive=True)
             except serial.serialutil.SerialException as exc:
-                logging.error("Serial error: %s", exc)
+                _log.error("Serial error: %s", exc)
                 time.sleep(interval)
 
     with get_port() as serial_port:
@@ -299,42 +645,37 @@ def run_script(device, script, serial_port: Optional[serial.Serial] = None, time
 
         boot_out = Path(device.mount_point) / "boot_out.txt"
         if boot_out.exists():
-            logging.info("BOOT: %s", boot_out.read_text())
+            _log.info("BOOT: %s", boot_out.read_text())
 
-        logging.info("Running script %s", description)
-        for line in script.splitlines():
-            logging.debug("Script: %s", line.decode('utf-8'))
+        _log.info("Running script %s", description)
+        for line in script_lines:
+            _log.debug("Script: %s", line)
 
-        serial_port.write([5])
+        # Ctrl-E enters paste mode; its banner line is the device's ACK that it's ready. Paste mode
+        # buffers everything until Ctrl-D, so the body and terminator can go in a single write.
+        serial_port.write(b"\x05")
         log_serial_output(serial_port.readline())
-        serial_port.write(script)
-        serial_port.write([13])
-        serial_port.flush()
-        time.sleep(0.1)
-        serial_port.write([4])
+        serial_port.write(payload)
         serial_port.flush()
-        with temporary_timeout(serial_port, 2):
-            try:
-                while serial_port.in_waiting:
-                    log_serial_output(serial_port.readline(serial_port.in_waiting))
-                    time.sleep(0.1)
-            except OSError:
-                pass
+        # Collect the echo and script output until the REPL prompt returns (or the board resets)
+        try:
+            log_serial_output(read_prompt(serial_port))
+        except OSError:
+            pass
 
 
 def log_serial_output(loggable: bytes):
+    if not _log.isEnabledFor(logging.DEBUG):
+        return
     for line in loggable.decode('utf-8').splitlines():
-        logging.debug("  << %s", line)
+        _log.debug("  << %s", line)
 
 
 def erase_filesystem(device):
     try:
         run_script(
             device,
-            script="""
-                import storage
-                storage.erase_filesystem()
-                """,
+            script=ERASE_SCRIPT,
             description="erase filesystem",
         )
         time.sleep(1)
@@ -348,66 +689,90 @@ def erase_filesystem(device):
     return device
 
 
-@contextmanager
-def temporary_timeout(port: serial.Serial, timeout: int):
-    cur_timeout = port.timeout
-    port.timeout = timeout
-    yield
-    port.timeout = cur_timeout
+def read_prompt(serial_port: serial.Serial, timeout: float = REPL_TIMEOUT) -> bytes:
+    """Drain whatever output is waiting until a REPL prompt shows up or timeout elapses."""
+    deadline = time.monotonic() + timeout
+    output = b""
+    while time.monotonic() < deadline:
+        time.sleep(REPL_POLL_INTERVAL)
+        output += serial_port.read(serial_port.in_waiting)
+        if b">>>" in output:
+            break
+    return output
 
 
-def acquire_repl(serial_port):
-    while True:
+def acquire_repl(serial_port, attempts=REPL_ATTEMPTS):
+    serial_port.reset_input_buffer()
+    for attempt in range(attempts):
+        check_stop()
         serial_port.write(b'\r')
-        with temporary_timeout(serial_port, 1):
-            output = serial_port.read_until(b">>> ")
-            if b">>>" in output:
-                log_serial_output(output)
-                logging.info("Found REPL")
+        output = read_prompt(serial_port)
+        if b">>>" in output:
+            log_serial_output(output)
+            _log.info("Found REPL")
+            return True
+        else:
+            _log.info("Sending Ctrl-C")
+            serial_port.write(b"\003\r\r")  # Ctrl-C LF
+            if b">>>" in read_prompt(serial_port):
+                time.sleep(0.1)
                 return True
-            else:
-                logging.info("Sending Ctrl-C")
-                serial_port.write(b"\003\r\r")  # Ctrl-C LF
-                if b">>>" in serial_port.read_until(b">>> "):
-                    time.sleep(0.1)
-                    return True
+    raise serial.SerialException(f"No REPL prompt after {attempts} attempts")
+
+
+def run_named(func, device: DeviceInfo):
+    # Pool threads are reused, so name them after the device for the log output
+    current_thread().name = device.serial_no
+    return func(device)
+
+
+def task_done(tasks: dict, serial_no: str, source: str, future: concurrent.futures.Future):
+    # Runs on the worker thread as soon as the flash ends (or in main() if it was cancelled)
+    tasks.pop(serial_no, None)
+    _log.info("Task done %s", serial_no)
+    exc = None
+    if future.cancelled():
+        _log.warning("Device %s %s flash cancelled", serial_no, source)
+    else:
+        exc = future.exception()
+        if isinstance(exc, ShutdownRequested):
+            _log.warning("Device %s %s flash abandoned at shutdown", serial_no, source)
+        elif exc:
+            _log.error("Device %s %s flash failed: %s", serial_no, source, exc, exc_info=exc)
+    if state.finish(serial_no, done=source == 'content' and not exc and not future.cancelled()):
+        _log.info("Device %s done %s, len=%d", serial_no, source, len(tasks))
 
 
 def main():
-    tasks_flash = []
-    tasks_boot = []
-    for device in discover_devices():
-        if device.serial_no in in_progress:
-            continue
-
-        logging.info("Discovered new device %s", device)
-        in_progress.add(device.serial_no)
-
-        if "BOOT" in device.mount_point:
-            logging.info("Run boot flash on device %s", device)
-            task = Thread(target=bootloader_flash, args=(device,), daemon=True, name=device.serial_no)
-            tasks_boot.append(task)
-            task.start()
-        else:
-            logging.info("Run content flash on device %s", device)
-            task = Thread(target=content_flash, args=(device,), daemon=True, name=device.serial_no)
-            tasks_flash.append(task)
-            task.start()
-
-        for source, tasks in (('content', tasks_flash), ('boot', tasks_boot)):
-            for task in list(tasks):
-                if not task.is_alive():
-                    tasks.remove(task)
-                    logging.info("Task done %s", task)
-                    if task.name in in_progress:
-                        in_progress.remove(task.name)
-                        if source == 'content':
-                            done_devices.add(task.name)
-                        logging.info("Device %s done %s, len=%d", task.name, source,
-                                     len(tasks))
-                    task.join()
-
-        time.sleep(0.25)
+    log_listener.start()
+    tasks: dict[str, concurrent.futures.Future] = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    # Load the source files up front so workers only ever write from memory
+    firmware_image()
+    content_plan()
+    Thread(target=watch_hotplug, daemon=True, name="hotplug").start()
+    try:
+        for device in discover_devices():
+            if not state.mark_in_progress(device.serial_no):
+                continue
+
+            _log.info("Discovered new device %s", device)
+
+            if "BOOT" in device.mount_point:
+                _log.info("Run boot flash on device %s", device)
+                source, flash = 'boot', bootloader_flash
+            else:
+                _log.info("Run content flash on device %s", device)
+                source, flash = 'content', content_flash
+            future = tasks[device.serial_no] = executor.submit(run_named, flash, device)
+            future.add_done_callback(functools.partial(task_done, tasks, device.serial_no, source))
+    finally:
+        # Queued flashes are dropped and running ones bail out at their next device/REPL wait; they
+        # are joined so their final records (including failures) still reach the log listener
+        _log.info("Shutting down, %d flashes still queued or running", len(tasks))
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        log_listener.stop()
 
 
 if __name__ == "__main__":